@@ -1,19 +1,13 @@
-import base64
-import os
+import asyncio
+import hashlib
 import google.generativeai as genai
-from dotenv import load_dotenv
 from enum import Enum
-from google.cloud import storage
-import json
-from google.oauth2 import service_account
 import logging
-load_dotenv()
+from cloud_storage import read_financial_statement
+from cache import AsyncTTLCache
 
 logger = logging.getLogger(__name__)
 
-# Configure Gemini
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-
 # Very powerful model for investment advice, do not use this yet
 super_model = genai.GenerativeModel(
     model_name="gemini-1.5-pro",
@@ -59,7 +53,7 @@ class QuestionType(Enum):
     COMPANY_GENERAL = "company-general"
     COMPANY_SPECIFIC_FINANCE = "company-specific-finance"
 
-def classify_question(question):
+async def classify_question(question):
     """
     Classify the question as either '{QuestionType.GENERAL_FINANCE.value}' or '{QuestionType.COMPANY_SPECIFIC.value}'.
     So that we can determine proper model to use for analysis.
@@ -76,7 +70,7 @@ def classify_question(question):
     {question}"""
 
     try:
-        response = classification_model.generate_content([prompt])
+        response = await classification_model.generate_content_async([prompt])
         if QuestionType.COMPANY_SPECIFIC_FINANCE.value in response.text.lower():
             return QuestionType.COMPANY_SPECIFIC_FINANCE.value
         elif QuestionType.COMPANY_GENERAL.value in response.text.lower():
@@ -89,55 +83,207 @@ def classify_question(question):
         print(f"Error during classifying type of question: {e}")
         return None
 
-def analyze_financial_data_from_question(ticker, question):
+# Analysis responses per (ticker, question hash)
+analysis_cache = AsyncTTLCache(maxsize=512, ttl=3600)
+
+# Maximum number of batch questions analyzed by Gemini at the same time, across all batch requests
+MAX_CONCURRENT_ANALYSES = 10
+_analysis_semaphore = asyncio.Semaphore(MAX_CONCURRENT_ANALYSES)
+
+class AnalysisError(Exception):
+    """
+    Raised when a question cannot be sent to the model, the message is returned to the user as is
+    """
+
+def _analysis_cache_key(ticker, question):
+    return (
+        ticker.lower().strip() if ticker else None,
+        hashlib.blake2b(question.encode()).hexdigest()
+    )
+
+async def analyze_financial_data_from_question(ticker, question, income_table=None, balance_table=None, cash_flow_table=None, statements_prefetched=False):
+    """
+    Analyze financial statements for a given ticker symbol or answer generic financial questions.
+    Responses are cached per ticker and question, errors are not cached.
+    
+    Args:
+        ticker (str): Stock ticker symbol (e.g., 'TSLA', 'AAPL')
+        question (str): Specific question about the financial data or generic financial concept
+        income_table (pa.Table): Income statement already in memory, read from cloud storage if not given
+        balance_table (pa.Table): Balance sheet already in memory, read from cloud storage if not given
+        cash_flow_table (pa.Table): Cash flow statement already in memory, read from cloud storage if not given
+        statements_prefetched (bool): Whether the caller already read the statements, so missing ones are not read again
+        
+    Returns:
+        dict: Object containing the analysis response {"data": str}
+    """
+    return await analysis_cache.get_or_set(
+        _analysis_cache_key(ticker, question),
+        lambda: _analyze_financial_data_from_question(
+            ticker, question, income_table, balance_table, cash_flow_table, statements_prefetched
+        ),
+        should_cache=lambda result: not result["data"].startswith("❌")
+    )
+
+async def analyze_financial_data_from_questions(ticker, questions):
+    """
+    Analyze financial statements for a given ticker symbol for several questions concurrently.
+    The statements are read from cloud storage once and shared across all the questions.
+    
+    Args:
+        ticker (str): Stock ticker symbol (e.g., 'TSLA', 'AAPL')
+        questions (list[str]): Questions about the financial data or generic financial concepts
+        
+    Returns:
+        list[dict]: Objects containing the analysis response {"data": str}, in the order of the questions
+    """
+    income_table = balance_table = cash_flow_table = None
+    statements_prefetched = False
+    if ticker:
+        try:
+            income_table, balance_table, cash_flow_table = await asyncio.gather(
+                read_financial_statement(ticker, "income_statement"),
+                read_financial_statement(ticker, "balance_sheet"),
+                read_financial_statement(ticker, "cash_flow")
+            )
+            # Statements missing now are reported as not found by each question instead of read again
+            statements_prefetched = True
+        except Exception as e:
+            # Each question reads the statements on its own and reports the error instead
+            logger.error(f"Error reading financial statements for the batch: {e}")
+
+    async def analyze(question):
+        async with _analysis_semaphore:
+            try:
+                return await analyze_financial_data_from_question(
+                    ticker, question, income_table, balance_table, cash_flow_table, statements_prefetched
+                )
+            except Exception as e:
+                # Report the failure for this question only, keeping the answers of the others
+                logger.error(f"Error during analysis of a batch question: {e}")
+                return {"data": f"❌ Error during analysis: {e}"}
+
+    return await asyncio.gather(*(analyze(question) for question in questions))
+
+async def stream_financial_data_from_question(ticker, question, income_table=None, balance_table=None, cash_flow_table=None):
+    """
+    Analyze financial statements for a given ticker symbol or answer generic financial questions,
+    yielding the response text as the model generates it. The full response is cached once streamed.
+    
+    Args:
+        ticker (str): Stock ticker symbol (e.g., 'TSLA', 'AAPL')
+        question (str): Specific question about the financial data or generic financial concept
+        income_table (pa.Table): Income statement already in memory, read from cloud storage if not given
+        balance_table (pa.Table): Balance sheet already in memory, read from cloud storage if not given
+        cash_flow_table (pa.Table): Cash flow statement already in memory, read from cloud storage if not given
+        
+    Yields:
+        str: Chunks of the analysis response
+    """
+    try:
+        key = _analysis_cache_key(ticker, question)
+        cached = analysis_cache.get(key)
+        if cached:
+            yield cached["data"]
+            return
+
+        analysis_model, contents = await _prepare_analysis(ticker, question, income_table, balance_table, cash_flow_table)
+    except AnalysisError as e:
+        yield str(e)
+        return
+    except Exception as e:
+        # The response has already started, so end the stream with an error event instead of cutting it off
+        yield f"❌ Error during analysis: {e}"
+        return
+
+    chunks = []
+    try:
+        response = await analysis_model.generate_content_async(contents, stream=True)
+        async for chunk in response:
+            chunks.append(chunk.text)
+            yield chunk.text
+    except Exception as e:
+        yield f"❌ Error during analysis: {e}"
+        return
+
+    if chunks:
+        analysis_cache.set(key, {"data": "".join(chunks)})
+
+async def _analyze_financial_data_from_question(ticker, question, income_table=None, balance_table=None, cash_flow_table=None, statements_prefetched=False):
     """
     Analyze financial statements for a given ticker symbol or answer generic financial questions
     
     Args:
         ticker (str): Stock ticker symbol (e.g., 'TSLA', 'AAPL')
         question (str): Specific question about the financial data or generic financial concept
+        income_table (pa.Table): Income statement already in memory, read from cloud storage if not given
+        balance_table (pa.Table): Balance sheet already in memory, read from cloud storage if not given
+        cash_flow_table (pa.Table): Cash flow statement already in memory, read from cloud storage if not given
+        statements_prefetched (bool): Whether the caller already read the statements, so missing ones are not read again
         
     Returns:
         dict: Object containing the analysis response {"data": str}
     """
+    try:
+        analysis_model, contents = await _prepare_analysis(
+            ticker, question, income_table, balance_table, cash_flow_table, statements_prefetched
+        )
+    except AnalysisError as e:
+        return {"data": str(e)}
 
-    classification = classify_question(question)
+    try:
+        response = await analysis_model.generate_content_async(contents)
+        return {"data": response.text} if response.text else {"data": "❌ No analysis generated from the model"}
+    except Exception as e:
+        return {"data": f"❌ Error during analysis: {e}"}
+
+async def _prepare_analysis(ticker, question, income_table=None, balance_table=None, cash_flow_table=None, statements_prefetched=False):
+    """
+    Pick the model and build the prompt answering a question, based on the type of the question
+    
+    Args:
+        ticker (str): Stock ticker symbol (e.g., 'TSLA', 'AAPL')
+        question (str): Specific question about the financial data or generic financial concept
+        income_table (pa.Table): Income statement already in memory, read from cloud storage if not given
+        balance_table (pa.Table): Balance sheet already in memory, read from cloud storage if not given
+        cash_flow_table (pa.Table): Cash flow statement already in memory, read from cloud storage if not given
+        statements_prefetched (bool): Whether the caller already read the statements, so missing ones are not read again
+        
+    Returns:
+        tuple: The model and the contents to generate the response with
+    Raises:
+        AnalysisError: If the financial statements needed for the question cannot be read
+    """
+
+    classification = await classify_question(question)
     logger.info(f"The question is classified as: {classification}")
 
     if classification == QuestionType.GENERAL_FINANCE.value:
-        try:
-            general_finance_model = genai.GenerativeModel(
-                model_name="gemini-1.5-pro",
-                system_instruction="""
-                You are a professional financial analyst who specializes in explaining financial concepts.
-                Give a short explanation of the financial question in less than 100 words.
-                Give an example of how this concept is used in real-world financial scenarios, using well-known companies and their financial statements.
-                """
-            )
-            response = general_finance_model.generate_content([
-                "Please explain this financial concept or answer this question:",
-                question
-            ])
-            return {"data": response.text} if response.text else {"data": "❌ No explanation generated"}
-        except Exception as e:
-            return {"data": f"❌ Error generating explanation: {e}"}
+        general_finance_model = genai.GenerativeModel(
+            model_name="gemini-1.5-pro",
+            system_instruction="""
+            You are a professional financial analyst who specializes in explaining financial concepts.
+            Give a short explanation of the financial question in less than 100 words.
+            Give an example of how this concept is used in real-world financial scenarios, using well-known companies and their financial statements.
+            """
+        )
+        return general_finance_model, [
+            "Please explain this financial concept or answer this question:",
+            question
+        ]
 
     if classification == QuestionType.COMPANY_GENERAL.value:
-        try:
-            company_general_model = genai.GenerativeModel(
-                model_name="gemini-1.5-pro",
-                system_instruction="""
-                    You are a professional investor who has a lot of knowledge about companies.
-                    You are able to answer questions about companies in general.
-                """
-            )
-            response = company_general_model.generate_content([
-                "Please answer this question:",
-                question
-            ])
-            return {"data": response.text} if response.text else {"data": "❌ No explanation generated"}
-        except Exception as e:
-            return {"data": f"❌ Error generating explanation: {e}"}
+        company_general_model = genai.GenerativeModel(
+            model_name="gemini-1.5-pro",
+            system_instruction="""
+                You are a professional investor who has a lot of knowledge about companies.
+                You are able to answer questions about companies in general.
+            """
+        )
+        return company_general_model, [
+            "Please answer this question:",
+            question
+        ]
     
     # If not generic, proceed with company-specific analysis
     if not ticker:
@@ -149,7 +295,7 @@ def analyze_financial_data_from_question(ticker, question):
                 Given a company name, find the stock ticker for the company.
             """
         )
-        response = ticker_model.generate_content([
+        response = await ticker_model.generate_content_async([
             "Please find the stock ticker for the company that is mentioned in the question:",
             question,
             "only return the ticker name without any other texts."
@@ -159,52 +305,36 @@ def analyze_financial_data_from_question(ticker, question):
     # Lower case and strip any whitespace
     ticker = ticker.lower().strip()
 
-    credentials = os.getenv('GOOGLE_APPLICATION_CREDENTIALS_JSON')
-    if not credentials:
-        return {"data": "❌ Google Cloud credentials not found in environment variables"}
-    
-    credentials_dict = json.loads(base64.b64decode(credentials).decode('utf-8'))
-    credentials = service_account.Credentials.from_service_account_info(credentials_dict)
-    client = storage.Client(credentials=credentials)
-    bucket = client.bucket('stock_agent_financial_report')
-    
-    if not bucket:
-        return {"data": "❌ GCP bucket name not configured"}
-        
-    try:
-        # Read files from GCP bucket
-        income_blob = bucket.blob(f"{ticker}_income_statement.csv")
-        balance_blob = bucket.blob(f"{ticker}_balance_sheet.csv")
-        cash_flow_blob = bucket.blob(f"{ticker}_cash_flow.csv")
-        
-        # TODO: may be do another classification to check which financial statement the question is asking for
-        # and then check if the file exists in the bucket and only throw if the relevant statement is missing
-        # instead of throwing an error if any of the statements are missing like now
-        if not (income_blob.exists() and balance_blob.exists() and cash_flow_blob.exists()):
-            return {"data": f"❌ Financial statements for {ticker.upper()} not found in cloud storage."}
-        
-        income_data = income_blob.download_as_text()
-        balance_data = balance_blob.download_as_text()
-        cash_flow_data = cash_flow_blob.download_as_text()
+    if (income_table is None or balance_table is None or cash_flow_table is None) and not statements_prefetched:
+        async def read_if_missing(table, report_type):
+            return table if table is not None else await read_financial_statement(ticker, report_type)
+
+        try:
+            # Read the statements not passed in from GCP bucket concurrently
+            income_table, balance_table, cash_flow_table = await asyncio.gather(
+                read_if_missing(income_table, "income_statement"),
+                read_if_missing(balance_table, "balance_sheet"),
+                read_if_missing(cash_flow_table, "cash_flow")
+            )
+        except Exception as e:
+            raise AnalysisError(f"❌ Error accessing cloud storage: {e}")
         
-    except Exception as e:
-        return {"data": f"❌ Error accessing cloud storage: {e}"}
+    # TODO: may be do another classification to check which financial statement the question is asking for
+    # and then check if the file exists in the bucket and only throw if the relevant statement is missing
+    # instead of throwing an error if any of the statements are missing like now
+    if income_table is None or balance_table is None or cash_flow_table is None:
+        raise AnalysisError(f"❌ Financial statements for {ticker.upper()} not found in cloud storage.")
 
     # Continue with analysis using the loaded data
-    try:
-        response = model.generate_content([
-            f"Here are financial statements for {ticker.upper()}:",
-            income_data,
-            "This is the income statement.",
-            balance_data,
-            "This is the balance sheet.",
-            cash_flow_data,
-            "This is the cash flow statement.",
-            analysis_prompt,
-            f"\nSpecific question to address: {question}"
-        ])
-
-        return {"data": response.text} if response.text else {"data": "❌ No analysis generated from the model"}
-
-    except Exception as e:
-        return {"data": f"❌ Error during analysis: {e}"}
+    # The model is prompted with the statements as CSV text, rendered in memory
+    return model, [
+        f"Here are financial statements for {ticker.upper()}:",
+        income_table.to_pandas().to_csv(index=False),
+        "This is the income statement.",
+        balance_table.to_pandas().to_csv(index=False),
+        "This is the balance sheet.",
+        cash_flow_table.to_pandas().to_csv(index=False),
+        "This is the cash flow statement.",
+        analysis_prompt,
+        f"\nSpecific question to address: {question}"
+    ]
@@ -0,0 +1,56 @@
+import asyncio
+from cachetools import TTLCache
+
+
+class AsyncTTLCache:
+    """
+    In-process LRU cache with expiry for results of coroutines.
+    Concurrent misses on the same key await the value computed for the first caller instead of all computing it.
+    """
+    def __init__(self, maxsize=512, ttl=3600):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._pending = {}
+
+    def get(self, key):
+        """
+        Get the cached value of a key, or None if it is not cached or expired
+        """
+        return self._cache.get(key)
+
+    def set(self, key, value):
+        """
+        Cache the value of a key
+        """
+        self._cache[key] = value
+
+    async def get_or_set(self, key, factory, should_cache=lambda value: True):
+        """
+        Get the cached value of a key, or compute it by awaiting factory()
+
+        Args:
+            key: Hashable cache key
+            factory: Function returning a coroutine that computes the value
+            should_cache: Function deciding whether a computed value is stored, e.g. to skip errors
+
+        Returns:
+            The cached or computed value
+        """
+        value = self._cache.get(key)
+        if value is not None:
+            return value
+
+        # Concurrent callers share the value being computed, also when it ends up not cached
+        task = self._pending.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._compute(key, factory, should_cache))
+            self._pending[key] = task
+        return await asyncio.shield(task)
+
+    async def _compute(self, key, factory, should_cache):
+        try:
+            value = await factory()
+            if should_cache(value):
+                self._cache[key] = value
+            return value
+        finally:
+            del self._pending[key]
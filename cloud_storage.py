@@ -0,0 +1,107 @@
+import aiohttp
+import base64
+import io
+import json
+import os
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from gcloud.aio.storage import Storage
+from cache import AsyncTTLCache
+
+BUCKET_NAME = "stock_agent_financial_report"
+
+# Maximum number of pooled connections to GCS, sized for the expected number of concurrent downloads
+MAX_CONNECTIONS = 64
+
+# Async storage client and its HTTP session shared across requests, built once by init_gcs_client() at startup
+_STORAGE = None
+_SESSION = None
+
+# Downloaded Parquet files per ticker, shared by all statements of the ticker
+ticker_file_cache = AsyncTTLCache(maxsize=128, ttl=3600)
+
+
+async def init_gcs_client():
+    """
+    Build the async Google Cloud Storage client from the base64 encoded service account JSON in the environment
+
+    Raises:
+        RuntimeError: If GOOGLE_APPLICATION_CREDENTIALS_JSON is not set
+    """
+    global _STORAGE, _SESSION
+
+    credentials = os.getenv('GOOGLE_APPLICATION_CREDENTIALS_JSON')
+    if not credentials:
+        raise RuntimeError("❌ Google credentials not found in environment variables")
+
+    # Reuse pooled connections to GCS across requests instead of paying the TCP and TLS handshake per download
+    _SESSION = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=MAX_CONNECTIONS))
+    _STORAGE = Storage(
+        service_file=io.StringIO(base64.b64decode(credentials).decode('utf-8')),
+        session=_SESSION
+    )
+
+
+async def close_gcs_client():
+    """
+    Close the HTTP session of the async Google Cloud Storage client
+    """
+    if _STORAGE:
+        await _STORAGE.close()
+    # Storage.close() leaves a session passed in by the caller open, so close it here
+    if _SESSION:
+        await _SESSION.close()
+
+
+async def _download_ticker_file(ticker):
+    """
+    Download the Parquet file holding all financial statements of a ticker
+
+    Returns:
+        pa.Buffer: Content of the file, or None if it does not exist in the bucket
+    """
+    try:
+        content = await _STORAGE.download(BUCKET_NAME, f"{ticker.lower()}.parquet")
+    except aiohttp.ClientResponseError as e:
+        if e.status == 404:
+            return None
+        raise
+
+    # Hand the downloaded bytes to pyarrow without copying them
+    return pa.py_buffer(content)
+
+
+async def read_financial_statement(ticker, report_type, metrics=None):
+    """
+    Read a financial statement of a ticker from the Parquet file written by the ingestion script.
+    The file holds all statements of the ticker and is downloaded once for all of them.
+
+    Args:
+        ticker (str): Stock ticker symbol (e.g., 'TSLA', 'AAPL')
+        report_type (str): income_statement, balance_sheet, or cash_flow
+        metrics (Iterable[str]): Lowercase metric names to keep, all rows are returned if not given
+
+    Returns:
+        pa.Table: The financial statement, or None if it does not exist in the bucket
+    """
+    content = await ticker_file_cache.get_or_set(
+        ticker.lower(),
+        lambda: _download_ticker_file(ticker),
+        should_cache=lambda content: content is not None
+    )
+    if content is None:
+        return None
+
+    # Only read the columns and row groups of the requested statement
+    metadata = pq.read_schema(pa.BufferReader(content)).metadata
+    columns = json.loads(metadata[b"report_type_columns"]).get(report_type)
+    if columns is None:
+        return None
+
+    filters = pc.field("report_type") == report_type
+    if metrics is not None:
+        # Filter on the metric names in the first column while reading, so unmatched rows are never decoded
+        filters &= pc.is_in(pc.utf8_lower(pc.field(columns[0])), value_set=pa.array(list(metrics)))
+
+    return pq.read_table(pa.BufferReader(content), columns=columns, filters=filters)
@@ -1,10 +1,4 @@
-import os
 import google.generativeai as genai
-from dotenv import load_dotenv
-
-load_dotenv()
-
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
 
 DEFAULT_QUESTIONS = [
     "What is the company's revenue?",
@@ -1,122 +1,111 @@
-import base64
-import json
 import os
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import APIRouter, FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-import pandas as pd
-from typing import Dict
-from google.cloud import storage
-from google.oauth2 import service_account
+from fastapi.responses import ORJSONResponse, StreamingResponse
+import orjson
+from typing import Annotated, Dict
+from contextlib import asynccontextmanager
 import logging
-from analyzer import analyze_financial_data_from_question
+import google.generativeai as genai
+from analyzer import analyze_financial_data_from_question, analyze_financial_data_from_questions, stream_financial_data_from_question
 from enum import Enum
 from constants import INCOME_STATEMENT_METRICS, BALANCE_SHEET_METRICS, CASH_FLOW_METRICS
 from faq_generator import get_frequent_ask_questions_for_ticker, get_general_frequent_ask_questions
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, StringConstraints, ValidationError
 from urllib.parse import urlencode
+from cloud_storage import init_gcs_client, close_gcs_client, read_financial_statement
+from cache import AsyncTTLCache
 
 load_dotenv()
 
 OUTPUT_DIR = "outputs"
-BUCKET_NAME = "stock_agent_financial_report"
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+router = APIRouter()
 
-# Add logging middleware
-@app.middleware("http")
-async def log_requests(request: Request, call_next):
-    response = await call_next(request)
-    logger.info(f"{request.method} {request.url.path} - {response.status_code}")
-    return response
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Fail fast on missing Google credentials instead of checking them on every request
+    await init_gcs_client()
+    yield
+    await close_gcs_client()
 
-# Configure CORS
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["http://localhost:3000", "https://stonkie.netlify.app"], 
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+class LogRequestsMiddleware:
+    """
+    Pure ASGI middleware logging the method, path and status code of every HTTP request
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                logger.info(f"{scope['method']} {scope['path']} - {message['status']}")
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
 
 # Health check
-@app.get("/api/health")
+@router.get("/api/health")
 async def health_check():
     return {"status": "ok"}
 
+# Parsed and filtered statements per (ticker, report_type)
+financial_statement_cache = AsyncTTLCache(maxsize=512, ttl=3600)
+
 class ReportType(Enum):
     INCOME_STATEMENT = "income_statement"
     BALANCE_SHEET = "balance_sheet"
     CASH_FLOW = "cash_flow"
 
-@app.get("/api/financial-data/{ticker}/{report_type}")
-async def get_financial_data(ticker: str, report_type: str) -> Dict:
+# Lowercase metric names to keep per report type, matched against the lowercased metric column
+METRICS_BY_REPORT_TYPE = {
+    ReportType.INCOME_STATEMENT: frozenset(metric.lower() for metric in INCOME_STATEMENT_METRICS),
+    ReportType.BALANCE_SHEET: frozenset(metric.lower() for metric in BALANCE_SHEET_METRICS),
+    ReportType.CASH_FLOW: frozenset(metric.lower() for metric in CASH_FLOW_METRICS),
+}
+
+@router.get("/api/financial-data/{ticker}/{report_type}")
+async def get_financial_data(ticker: str, report_type: ReportType) -> Dict:
     """
     Get financial data for a specific ticker and report type
-    report_type can be: income_statement, balance_sheet, or cash_flow
+    report_type can be: income_statement, balance_sheet, or cash_flow, FastAPI rejects other values with 422
     """
     try:
-        # Validate and convert report_type to enum
-        try:
-            report_type_enum = ReportType(report_type)
-        except ValueError:
-            raise HTTPException(
-                status_code=400, 
-                detail=f"Invalid report type. Must be one of: {[rt.value for rt in ReportType]}"
-            )
-
-        # Get the CSV from google cloud storage
-        credentials = os.getenv('GOOGLE_APPLICATION_CREDENTIALS_JSON')
-        if not credentials:
-            print("❌ Google credentials not found in environment variables")
-            return {
-                "data": [],
-            }
+        # Filter rows based on report type
+        selected_metrics = METRICS_BY_REPORT_TYPE[report_type]
 
-        credentials_dict = json.loads(base64.b64decode(credentials).decode('utf-8'))
-        credentials = service_account.Credentials.from_service_account_info(credentials_dict)
-        storage_client = storage.Client(credentials=credentials)
+        async def load_statement():
+            return await read_financial_statement(ticker, report_type.value, metrics=selected_metrics)
 
-        csv_blob = storage_client.bucket(BUCKET_NAME).blob(f"{ticker.lower()}_{report_type}.csv")
-        
-        # If the CSV doesn't exist, return an empty data object
-        if not csv_blob.exists():
+        # If the statement doesn't exist, return an empty data object, and look it up again on the next request
+        table = await financial_statement_cache.get_or_set(
+            (ticker.lower(), report_type),
+            load_statement,
+            should_cache=lambda table: table is not None
+        )
+        if table is None:
             return {
                 "data": [],
                 "columns": []
             }
-        
-        # Download the blob as string and convert to bytes
-        csv_content = csv_blob.download_as_string()
-        
-        # Use pandas to read the CSV content from the string
-        df = pd.read_csv(pd.io.common.BytesIO(csv_content))
-        
-        # Filter columns based on report type
-        metric_mapping = {
-            ReportType.INCOME_STATEMENT: INCOME_STATEMENT_METRICS,
-            ReportType.BALANCE_SHEET: BALANCE_SHEET_METRICS,
-            ReportType.CASH_FLOW: CASH_FLOW_METRICS
-        }
-        
-        selected_metrics = metric_mapping[report_type_enum]
-        first_col_name = df.columns[0]
-        df = df[df[first_col_name].str.lower().isin(selected_metrics)]
-        
-        # Convert the dataframe to JSON format
-        return {
-            "data": df.to_dict('records'),
-            "columns": df.columns.tolist()
-        }
+
+        # Convert the Arrow table to JSON format in C without going through pandas, serialized by orjson as is
+        return ORJSONResponse({
+            "data": table.to_pylist(),
+            "columns": table.column_names
+        })
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/api/company/analyze")
+@router.post("/api/company/analyze")
 async def analyze_financial_data(request: Request):
     """
     Analyze financial statements for a given ticker symbol based on a specific question
@@ -127,14 +116,14 @@ async def analyze_financial_data(request: Request):
         dict: Analysis response and status
     """
     try:
-        body = await request.json()
+        body = orjson.loads(await request.body())
         question = body.get('question')
         ticker = body.get('ticker')
         
         if not question:
             raise HTTPException(status_code=400, detail="Question is required in request body")
 
-        analysis_result = analyze_financial_data_from_question(ticker, question)
+        analysis_result = await analyze_financial_data_from_question(ticker, question)
 
         return {
             "status": "success",
@@ -145,7 +134,76 @@ async def analyze_financial_data(request: Request):
         raise HTTPException(status_code=500, detail=f"Something went wrong. Please try again later.")
 
 
-@app.get("/api/company/faq")
+class AnalysisRequest(BaseModel):
+    ticker: str | None = None
+    question: Annotated[str, StringConstraints(strip_whitespace=True, min_length=1)]
+
+@router.post("/api/company/analyze-stream")
+async def stream_financial_data_analysis(request: Request):
+    """
+    Analyze financial statements for a given ticker symbol based on a specific question,
+    streaming the response as Server-Sent Events while the model generates it
+    
+    Args:
+        request (Request): FastAPI request object containing the question and ticker in body
+    Returns:
+        StreamingResponse: Events of the form data: {"text": str}
+    """
+    # Validate the body before the response starts, errors after that can only be sent as events
+    try:
+        body = AnalysisRequest.model_validate(orjson.loads(await request.body()))
+    except (orjson.JSONDecodeError, ValidationError):
+        raise HTTPException(status_code=400, detail="Question is required in request body")
+
+    async def events():
+        async for text in stream_financial_data_from_question(body.ticker, body.question):
+            yield f"data: {orjson.dumps({'text': text}).decode()}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+# Maximum number of questions in one batch, each of them is a paid Gemini call
+MAX_BATCH_QUESTIONS = 10
+
+class BatchAnalysisRequest(BaseModel):
+    ticker: str | None = None
+    questions: list[Annotated[str, StringConstraints(strip_whitespace=True, min_length=1)]] = Field(
+        min_length=1, max_length=MAX_BATCH_QUESTIONS
+    )
+
+@router.post("/api/company/analyze-batch")
+async def analyze_financial_data_batch(request: Request):
+    """
+    Analyze financial statements for a given ticker symbol based on several questions at once
+    
+    Args:
+        request (Request): FastAPI request object containing the list of questions and ticker in body
+    Returns:
+        dict: Analysis responses in the order of the questions and status
+    """
+    try:
+        try:
+            body = BatchAnalysisRequest.model_validate(orjson.loads(await request.body()))
+        except (orjson.JSONDecodeError, ValidationError):
+            raise HTTPException(
+                status_code=400,
+                detail=f"A list of 1 to {MAX_BATCH_QUESTIONS} non-empty questions is required in request body"
+            )
+
+        analysis_results = await analyze_financial_data_from_questions(body.ticker, body.questions)
+
+        return {
+            "status": "success",
+            "data": analysis_results
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error during batch analysis: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Something went wrong. Please try again later.")
+
+
+@router.get("/api/company/faq")
 async def get_faq(request: Request):
     """
     Suggest 3 FAQs for a given ticker symbol
@@ -179,7 +237,7 @@ def get_company_logo_url(company_name: str):
     return f"https://cdn.brandfetch.io/{company_name.lower()}.com/w/100/h/100?{params}"
 
 
-@app.get("/api/companies/most-viewed")
+@router.get("/api/companies/most-viewed")
 async def get_most_viewed_companies():
     """
     Get the most viewed companies
@@ -202,5 +260,32 @@ async def get_most_viewed_companies():
     }
 
 
+def create_app():
+    """
+    Build the FastAPI app, this is the only place configuring logging, Gemini and middlewares
+    """
+    # Configure logging
+    logging.basicConfig(level=logging.INFO)
+
+    # Configure Gemini
+    genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
 
-        
+    app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+    app.include_router(router)
+
+    # Add logging middleware
+    app.add_middleware(LogRequestsMiddleware)
+
+    # Configure CORS
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["http://localhost:3000", "https://stonkie.netlify.app"], 
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+
+    return app
+
+
+app = create_app()
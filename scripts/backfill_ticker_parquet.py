@@ -0,0 +1,73 @@
+"""
+One-shot backfill merging the financial statements stored per statement in gcloud storage,
+as {ticker}_{report_type}.csv or {ticker}_{report_type}.parquet, into the {ticker}.parquet file read by the API.
+Run it once before deploying the API reading the merged files:
+
+    python scripts/backfill_ticker_parquet.py [--force]
+
+Tickers that already have a merged file are skipped unless --force is given.
+"""
+import os
+import sys
+import tempfile
+from google.cloud import storage
+from export_financial_report import REPORT_TYPES, upload_ticker_parquet
+
+BUCKET_NAME = "stock_agent_financial_report"
+
+def find_legacy_statements(bucket):
+    """
+    List the statements stored on their own in gcloud storage and the tickers already merged
+    
+    Returns:
+        tuple: {ticker: {report_type: blob}} of the legacy statements, and the set of merged tickers
+    """
+    legacy_statements = {}
+    merged_tickers = set()
+
+    for blob in bucket.list_blobs():
+        stem, extension = os.path.splitext(blob.name)
+        if extension not in (".csv", ".parquet"):
+            continue
+
+        report_type = next((rt for rt in REPORT_TYPES if stem.endswith(f"_{rt}")), None)
+        if report_type is None:
+            if extension == ".parquet":
+                merged_tickers.add(stem)
+            continue
+
+        ticker = stem[:-len(report_type) - 1]
+        statements = legacy_statements.setdefault(ticker, {})
+        # Prefer the Parquet file over the CSV it was converted from
+        if report_type not in statements or extension == ".parquet":
+            statements[report_type] = blob
+
+    return legacy_statements, merged_tickers
+
+def main():
+    force = "--force" in sys.argv[1:]
+    bucket = storage.Client().bucket(BUCKET_NAME)
+
+    legacy_statements, merged_tickers = find_legacy_statements(bucket)
+    print(f"🔍 Found legacy statements for {len(legacy_statements)} tickers")
+
+    for ticker, statements in sorted(legacy_statements.items()):
+        if ticker in merged_tickers and not force:
+            print(f"✅💲 {ticker}.parquet already exists, skipping")
+            continue
+
+        try:
+            # Download into a fresh directory so no stale local exports end up in the merged file
+            with tempfile.TemporaryDirectory() as output_dir:
+                for blob in statements.values():
+                    blob.download_to_filename(os.path.join(output_dir, blob.name))
+
+                report_types = [rt for rt in REPORT_TYPES if rt in statements]
+                upload_ticker_parquet(bucket, ticker, output_dir, report_types=report_types)
+        except Exception as e:
+            print(f"❌❌ Failed to merge the statements of {ticker}: {e}")
+
+
+# Run the script
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,10 @@
 import csv
+import io
 import os
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 from playwright.sync_api import sync_playwright
 from dotenv import load_dotenv
 import google.generativeai as genai
@@ -62,6 +67,7 @@ load_dotenv()
 genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
 
 OUTPUT_DIR = "outputs"
+REPORT_TYPES = ["income_statement", "balance_sheet", "cash_flow"]
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 def export_financial_data_to_image(url, file_name):
@@ -145,6 +151,111 @@ def save_to_csv(data, filename="financial_data.csv", output_dir="outputs"):
     except Exception as e:
         print(f"❌❌❌ Error saving CSV file: {e}")
 
+def parse_numbers(column):
+    """
+    Convert a text column of numbers to float, e.g. values saved with a leading space or as "N/A".
+    The column is returned unchanged if it holds other texts.
+    """
+    values = pc.utf8_trim_whitespace(column)
+    values = pc.if_else(pc.equal(values, "N/A"), pa.scalar(None, pa.string()), values)
+    try:
+        return pc.cast(values, pa.float64())
+    except pa.ArrowInvalid:
+        return column
+
+def read_statement(file_name, output_dir="outputs"):
+    """
+    Read a financial statement exported to the output directory as an Arrow table
+    
+    Args:
+        file_name (str): Name of the financial statement without extension, e.g. tsla_income_statement
+        output_dir (str): Directory containing the CSV file, or the Parquet file of a statement stored on its own before
+    """
+    parquet_path = os.path.join(output_dir, f"{file_name}.parquet")
+    if os.path.exists(parquet_path):
+        return pq.read_table(parquet_path)
+
+    # save_to_csv drops the empty cells of a row, so pad short rows to the width of the header like pandas did
+    with open(os.path.join(output_dir, f"{file_name}.csv"), newline='', encoding='utf-8') as f:
+        rows = list(csv.reader(f))
+    width = len(rows[0]) if rows else 0
+    padded = io.StringIO()
+    csv.writer(padded).writerows(row + [""] * (width - len(row)) for row in rows)
+
+    table = pacsv.read_csv(
+        pa.BufferReader(padded.getvalue().encode('utf-8')),
+        read_options=pacsv.ReadOptions(use_threads=True),
+        convert_options=pacsv.ConvertOptions(strings_can_be_null=True)
+    )
+
+    # The first column holds the metric names, the rest are the values of each period
+    for index, name in enumerate(table.column_names[1:], start=1):
+        if pa.types.is_string(table.schema.field(index).type):
+            table = table.set_column(index, name, parse_numbers(table.column(index)))
+
+    return table
+
+def upload_ticker_parquet(bucket, ticker, output_dir="outputs", report_types=REPORT_TYPES):
+    """
+    Merge all financial statements of a ticker into a single Parquet file and upload it to gcloud storage,
+    so the API and the analyzer fetch one file per ticker instead of one per statement.
+    The statements share one schema with a report_type column, each statement is written as its own row groups,
+    and the columns of each statement are kept in the schema metadata under "report_type_columns".
+    
+    Args:
+        bucket: gcloud storage bucket to upload the Parquet file to
+        ticker (str): Stock ticker symbol in lower case (e.g., 'tsla', 'aapl')
+        output_dir (str): Directory containing the exported statements
+        report_types (list[str]): Statements to merge, e.g. only the ones a ticker has in gcloud storage
+    """
+    tables = {report_type: read_statement(f"{ticker}_{report_type}", output_dir) for report_type in report_types}
+
+    # The same period can be parsed as int in one statement and float in another, so promote to a common type
+    schema = pa.unify_schemas([table.schema for table in tables.values()], promote_options="permissive")
+    schema = schema.append(pa.field("report_type", pa.string()))
+    schema = schema.with_metadata({
+        "report_type_columns": json.dumps({report_type: table.column_names for report_type, table in tables.items()})
+    })
+
+    parquet_path = os.path.join(output_dir, f"{ticker}.parquet")
+    with pq.ParquetWriter(parquet_path, schema, compression='snappy') as writer:
+        for report_type, table in tables.items():
+            columns = {
+                field.name: table.column(field.name).cast(field.type)
+                if field.name in table.column_names else pa.nulls(table.num_rows, field.type)
+                for field in schema if field.name != "report_type"
+            }
+            columns["report_type"] = pa.array([report_type] * table.num_rows, pa.string())
+            writer.write_table(pa.table(columns, schema=schema))
+
+    print(f"🗂️ Uploading {ticker}.parquet to gcloud storage...")
+    bucket.blob(f"{ticker}.parquet").upload_from_filename(parquet_path)
+    print(f"🗂️ Done uploading {ticker}.parquet to gcloud storage")
+
+def download_ticker_parquet(bucket, ticker, output_dir="outputs"):
+    """
+    Download the merged Parquet file of a ticker from gcloud storage and split it back into one Parquet file
+    per statement in the output directory, so the statements it is missing can be exported and merged with them.
+    
+    Args:
+        bucket: gcloud storage bucket holding the Parquet file
+        ticker (str): Stock ticker symbol in lower case (e.g., 'tsla', 'aapl')
+        output_dir (str): Directory to save the statements to
+    
+    Returns:
+        list[str]: Report types of the statements in the merged file
+    """
+    parquet_path = os.path.join(output_dir, f"{ticker}.parquet")
+    print(f"🗂️ Downloading {ticker}.parquet from gcloud storage...")
+    bucket.blob(f"{ticker}.parquet").download_to_filename(parquet_path)
+
+    report_type_columns = json.loads(pq.read_schema(parquet_path).metadata[b"report_type_columns"])
+    for report_type, columns in report_type_columns.items():
+        table = pq.read_table(parquet_path, columns=columns, filters=pc.field("report_type") == report_type)
+        pq.write_table(table.replace_schema_metadata(), os.path.join(output_dir, f"{ticker}_{report_type}.parquet"))
+
+    return list(report_type_columns)
+
 model = genai.GenerativeModel(
    model_name="gemini-1.5-pro",
    system_instruction="""
@@ -182,17 +293,24 @@ def export_financial_data_to_csv(url, file_name, force=False):
   storage_client = storage.Client()
   bucket = storage_client.bucket('stock_agent_financial_report')
 
-  # Check if the output already exists from gcloud storage
+  # Check if the statement was already exported locally
+  csv_path = os.path.join(OUTPUT_DIR, f"{file_name}.csv")
+  parquet_path = os.path.join(OUTPUT_DIR, f"{file_name}.parquet")
+  if os.path.exists(csv_path) or os.path.exists(parquet_path):
+    print(f"✅💲 {file_name} already exists in {OUTPUT_DIR}")
+    return
+
+  # Check if the statement was stored on its own in gcloud storage before, then download it for merging
+  parquet_blob = bucket.blob(f"{file_name}.parquet")
+  if parquet_blob.exists():
+    print(f"🗂️ Downloading {file_name}.parquet from gcloud storage...")
+    parquet_blob.download_to_filename(parquet_path)
+    return
+
   csv_blob = bucket.blob(f"{file_name}.csv")
   if csv_blob.exists():
-    print(f"✅💲 {file_name} CSV already exists in {csv_blob.public_url}. Enjoy investing!")
-    return
-  
-  # Check if the CSV already exists locally, then upload it to gcloud storage
-  if os.path.exists(os.path.join(OUTPUT_DIR, f"{file_name}.csv")):
-    print(f"🗂️ Uploading {file_name}.csv to gcloud storage...")
-    csv_blob.upload_from_filename(os.path.join(OUTPUT_DIR, f"{file_name}.csv"))
-    print(f"🗂️ Done uploading {file_name}.csv to gcloud storage")
+    print(f"🗂️ Downloading {file_name}.csv from gcloud storage...")
+    csv_blob.download_to_filename(csv_path)
     return
   
   # Check if the image already exists in gcloud storage
@@ -226,11 +344,6 @@ def export_financial_data_to_csv(url, file_name, force=False):
   if response.text:
       save_to_csv(response.text, f'{file_name}.csv', OUTPUT_DIR)
 
-      # Upload the CSV to gcloud storage
-      print(f"🗂️ Uploading {file_name}.csv to gcloud storage...")
-      csv_blob.upload_from_filename(os.path.join(OUTPUT_DIR, f"{file_name}.csv"))
-      print(f"🗂️ Done uploading {file_name}.csv to gcloud storage")
-
   else:
       print("❌❌❌ No data received from the model")
 
@@ -255,6 +368,17 @@ def main():
     # Get ticker symbol from user
     ticker = input("Enter stock ticker symbol (e.g., TSLA, AAPL): ").strip()
     
+    # Check if the merged statements already exist from gcloud storage
+    bucket = storage.Client().bucket('stock_agent_financial_report')
+    ticker_blob = bucket.blob(f"{ticker.lower()}.parquet")
+    if ticker_blob.exists():
+        merged_report_types = download_ticker_parquet(bucket, ticker.lower(), OUTPUT_DIR)
+        if all(report_type in merged_report_types for report_type in REPORT_TYPES):
+            print(f"✅💲 {ticker.upper()} financial statements already exist in {ticker_blob.public_url}. Enjoy investing!")
+            return
+        # The statements already merged are found locally below, so only the missing ones are exported
+        print(f"🔍 {ticker.upper()} financial statements only have {', '.join(merged_report_types)}, adding the missing ones")
+
     # Generate URLs for the given ticker
     financial_statement_url, balance_sheet_url, cash_flow_url = get_financial_urls(ticker)
     
@@ -274,7 +398,21 @@ def main():
         f"{ticker.lower()}_cash_flow", 
     )
 
+    # Merge the statements exported successfully into one Parquet file for the ticker
+    report_types = [
+        report_type for report_type in REPORT_TYPES
+        if any(
+            os.path.exists(os.path.join(OUTPUT_DIR, f"{ticker.lower()}_{report_type}.{extension}"))
+            for extension in ("csv", "parquet")
+        )
+    ]
+    if not report_types:
+        print(f"❌❌ No financial statements of {ticker.upper()} were exported")
+        return
+
+    upload_ticker_parquet(bucket, ticker.lower(), OUTPUT_DIR, report_types=report_types)
+
 
 # Run the script
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()